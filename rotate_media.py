@@ -1,7 +1,15 @@
 #!/usr/bin/env python3
 import os
+import ctypes
+import heapq
+import itertools
 import json
+import math
+import struct
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from errno import ENOENT
 from pathlib import Path
 
 # ===== CONFIG =====
@@ -21,7 +29,19 @@ LOG_DIR = Path("/mnt/movies/.logs")
 CORE_CACHE_FILE = LOG_DIR / "core_hashes.json"
 
 # STATE_FILE stores the timestamp of the last run so the script can identify new files.
-STATE_FILE = LOG_DIR / "rotation_state.json"
+# It also records the archive directory's own mtime so an unchanged archive can be detected cheaply.
+# Both values are packed as two little-endian doubles, so loading it is a single 16 byte read.
+STATE_FILE = LOG_DIR / "rotation_state.bin"
+STATE_FORMAT = struct.Struct("<dd")
+
+# LEGACY_STATE_FILE is the JSON state written by previous versions of this project.
+# It is only read when STATE_FILE does not exist yet, so upgrades keep their last run time.
+LEGACY_STATE_FILE = LOG_DIR / "rotation_state.json"
+
+# ARCHIVE_CACHE_FILE holds the archive listing from the last full scan, sorted alphabetically, one name per line.
+# It is reused while the archive directory's mtime is unchanged, so the scan can be skipped.
+# It is read line by line, so a run only reads as far into it as it needs to fill the shelf.
+ARCHIVE_CACHE_FILE = LOG_DIR / "archive_names.txt"
 
 # Maximum number of rotation entries allowed at any given time.
 # This number comes from cognitive load research and long term observation.
@@ -32,33 +52,116 @@ MAX_ROTATION_ITEMS = 1000
 # This gives the system a predictable rhythm and prevents the rotation shelf from going stale.
 LINK_MAX_AGE_DAYS = 30
 
+# The archive directory's mtime is only trusted once it is at least this many seconds old.
+# Filesystem timestamps are coarse (up to a couple of seconds on SMB or FAT style shares), so a title
+# added in the same tick as the scan would not move the mtime. A fresher mtime forces a rescan next run.
+MTIME_SAFETY_MARGIN = 2.0
+
 # Names that should be ignored during scans of the archive.
 # These are noise files created by macOS, Synology, Syncthing, and similar tools.
 IGNORE_NAMES = {".DS_Store", "@eaDir", ".stfolder", ".stversions"}
 
+# Number of threads used to stat archive entries.
+# stat() releases the GIL, and on a network share each call mostly waits on the NAS,
+# so several requests in flight at once hide most of that latency.
+STAT_WORKERS = 16
+
+# Below this many entries the archive is stat'd on the main thread.
+# Starting the pool costs more than it saves for a handful of entries.
+STAT_PARALLEL_MIN = 512
+
+# Read archive mtimes with statx(STATX_MTIME, AT_STATX_DONT_SYNC) instead of os.stat.
+# Only worth enabling when MOVIES_DIR is a network mount (NFS/SMB) that can answer from cache.
+# On a local disk the ctypes call is about twice as slow as os.stat, so it is off by default.
+USE_STATX = False
+
 # Ensure required directories exist. This prevents failures on first run.
 LOG_DIR.mkdir(parents=True, exist_ok=True)
 ROTATION_DIR.mkdir(parents=True, exist_ok=True)
 
 
+# Log lines waiting to be written. They are flushed once per phase rather than once per line.
+_log_lines = []
+
+# The last formatted timestamp prefix and the second it belongs to.
+# Many lines are logged within the same second, so strftime only runs when the second changes.
+_log_second = None
+_log_prefix = ""
+
+
 def log(msg: str):
     """Simple timestamped logger so each step can be seen clearly in the terminal."""
-    ts = time.strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{ts}] {msg}", flush=True)
+    global _log_second, _log_prefix
+    now = int(time.time())
+    if now != _log_second:
+        _log_second = now
+        _log_prefix = time.strftime("[%Y-%m-%d %H:%M:%S] ", time.localtime(now))
+    _log_lines.append(f"{_log_prefix}{msg}\n")
+
+
+def flush_log():
+    """Write all buffered log lines to the terminal in a single write."""
+    sys.stdout.writelines(_log_lines)
+    sys.stdout.flush()
+    _log_lines.clear()
 
 
 def load_state():
     """Load the previous run's timestamp. If none exists, assume this is the first run."""
-    if not STATE_FILE.exists():
+    try:
+        with open(STATE_FILE, "rb") as f:
+            data = f.read(STATE_FORMAT.size)
+    except FileNotFoundError:
+        # Only an upgrade from the JSON state has no binary file yet.
+        if LEGACY_STATE_FILE.exists():
+            with open(LEGACY_STATE_FILE, "r", encoding="utf-8") as f:
+                return json.load(f)
         return {"last_run": 0}
-    with open(STATE_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    if len(data) != STATE_FORMAT.size:
+        log(f"Ignoring malformed state file {STATE_FILE}")
+        return {"last_run": 0}
+    last_run, movies_dir_mtime = STATE_FORMAT.unpack(data)
+    state = {"last_run": last_run}
+    # NaN marks an archive mtime that was never recorded.
+    if not math.isnan(movies_dir_mtime):
+        state["movies_dir_mtime"] = movies_dir_mtime
+    return state
 
 
 def save_state(state: dict):
     """Save the timestamp of the current run so the next execution can detect new entries."""
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, indent=2)
+    data = STATE_FORMAT.pack(state["last_run"], state.get("movies_dir_mtime", float("nan")))
+    # Write a temporary file and swap it into place, so an interrupted run never leaves a short
+    # state file behind that would make the whole archive look new.
+    tmp_file = STATE_FILE.with_name(STATE_FILE.name + ".tmp")
+    with open(tmp_file, "wb") as f:
+        f.write(data)
+    os.replace(tmp_file, STATE_FILE)
+
+
+def iter_archive_cache(skip: set[str]):
+    """
+    Yield cached archive names in alphabetical order, leaving out any name in skip.
+    Names are read lazily and checked to still exist, so only the entries actually consumed cost any work.
+    """
+    movies_root = os.fspath(MOVIES_DIR)
+    with open(ARCHIVE_CACHE_FILE, "r", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+        for line in f:
+            name = line[:-1]
+            if name in skip:
+                continue
+            if os.path.lexists(os.path.join(movies_root, name)):
+                yield name
+
+
+def save_archive_cache(names: list[str]):
+    """Save the sorted archive listing so an unchanged archive does not need to be rescanned."""
+    if any("\n" in name for name in names):
+        # A name containing a newline cannot be stored one per line, so go without a cache this time.
+        ARCHIVE_CACHE_FILE.unlink(missing_ok=True)
+        return
+    with open(ARCHIVE_CACHE_FILE, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+        f.writelines(f"{name}\n" for name in names)
 
 
 def load_core_dirnames() -> set[str]:
@@ -68,48 +171,66 @@ def load_core_dirnames() -> set[str]:
     """
     names = set()
     if CORE_DIR.exists():
-        for p in CORE_DIR.iterdir():
-            if p.is_dir() or p.is_file():
-                names.add(p.name)
+        with os.scandir(CORE_DIR) as it:
+            for entry in it:
+                if entry.is_dir() or entry.is_file():
+                    names.add(entry.name)
     return names
 
 
 def list_rotation_links():
     """
-    Return a list of all symbolic links in the rotation directory.
+    Return a list of (entry, lstat) pairs for all symbolic links in the rotation directory.
     Only links matter because the rotation shelf should contain no real files.
+    The lstat result is captured once here so later steps never need to stat the link again.
+    A link that disappears before it can be stat'd is reported with a stat of None.
     """
     links = []
-    for p in ROTATION_DIR.iterdir():
-        if p.is_symlink():
-            links.append(p)
+    with os.scandir(ROTATION_DIR) as it:
+        for entry in it:
+            if entry.is_symlink():
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except FileNotFoundError:
+                    st = None
+                links.append((entry, st))
     return links
 
 
-def remove_old_links(links):
+def _unlink_quiet(name: str, dir_fd: int):
+    """Remove a directory entry relative to dir_fd, ignoring the case where it has already disappeared."""
+    try:
+        os.unlink(name, dir_fd=dir_fd)
+    except FileNotFoundError:
+        pass
+
+
+def remove_old_links(links, rot_fd: int):
     """
     Remove symbolic links that have aged past the configured limit.
     This ensures the rotation shelf does not become stale.
+    Links are removed with unlinkat(2) against the open rotation directory, so no path is resolved per link.
+    Returns the links that survived, so the caller does not need to rescan the directory.
     """
     now = time.time()
     cutoff = now - (LINK_MAX_AGE_DAYS * 24 * 60 * 60)
     removed = 0
-    for link in links:
+    kept = []
+    for link, st in links:
         try:
-            st = link.lstat()
             # Remove links older than the cutoff.
-            if st.st_mtime < cutoff:
-                link.unlink(missing_ok=True)
+            # Links that vanished before they could be stat'd should always be removed.
+            if st is None or st.st_mtime < cutoff:
+                _unlink_quiet(link.name, rot_fd)
                 removed += 1
-        except FileNotFoundError:
-            # Broken links should always be removed.
-            link.unlink(missing_ok=True)
-            removed += 1
+            else:
+                kept.append((link, st))
         except Exception as e:
-            log(f"Warning removing old link {link}: {e}")
+            log(f"Warning removing old link {link.path}: {e}")
+            kept.append((link, st))
     if removed:
         log(f"Removed {removed} old rotation links")
-    return removed
+    return kept
 
 
 def scan_movies():
@@ -117,99 +238,241 @@ def scan_movies():
     Scan the full archive.
     Only real movie folders or files are collected.
     Noise entries are filtered out.
+    Entries are returned as os.DirEntry objects so later stat() calls
+    can reuse the type information already gathered by scandir.
     """
-    items = []
-    for entry in MOVIES_DIR.iterdir():
-        if entry.name in IGNORE_NAMES:
-            continue
-        if entry.is_dir() or entry.is_file():
-            items.append(entry)
-    return items
+    # is_dir()/is_file() answer from readdir's d_type for plain folders and files, with no syscall.
+    # Symlinks are still followed so linked titles count, and DirEntry caches that one stat for both checks.
+    with os.scandir(MOVIES_DIR) as it:
+        return [
+            entry
+            for entry in it
+            if entry.name not in IGNORE_NAMES and (entry.is_dir() or entry.is_file())
+        ]
+
+
+class _StatxTimestamp(ctypes.Structure):
+    """struct statx_timestamp from <linux/stat.h>."""
+
+    _fields_ = [
+        ("tv_sec", ctypes.c_int64),
+        ("tv_nsec", ctypes.c_uint32),
+        ("__reserved", ctypes.c_int32),
+    ]
+
+
+class _Statx(ctypes.Structure):
+    """struct statx from <linux/stat.h>. Fields after stx_mtime are never read and kept as padding."""
+
+    _fields_ = [
+        ("stx_mask", ctypes.c_uint32),
+        ("stx_blksize", ctypes.c_uint32),
+        ("stx_attributes", ctypes.c_uint64),
+        ("stx_nlink", ctypes.c_uint32),
+        ("stx_uid", ctypes.c_uint32),
+        ("stx_gid", ctypes.c_uint32),
+        ("stx_mode", ctypes.c_uint16),
+        ("__spare0", ctypes.c_uint16),
+        ("stx_ino", ctypes.c_uint64),
+        ("stx_size", ctypes.c_uint64),
+        ("stx_blocks", ctypes.c_uint64),
+        ("stx_attributes_mask", ctypes.c_uint64),
+        ("stx_atime", _StatxTimestamp),
+        ("stx_btime", _StatxTimestamp),
+        ("stx_ctime", _StatxTimestamp),
+        ("stx_mtime", _StatxTimestamp),
+        ("__spare", ctypes.c_uint8 * 128),
+    ]
+
+
+# statx(2) flags. Only the mtime is requested, and the filesystem is allowed
+# to answer from its cache instead of syncing with the server first.
+AT_STATX_DONT_SYNC = 0x4000
+STATX_MTIME = 0x40
+
+
+def _load_statx():
+    """
+    Load statx from the C library already in this process (glibc 2.28+).
+    CDLL(None) resolves symbols from the running process, so no ldconfig lookup is needed.
+    Returns None when USE_STATX is off or statx is unavailable, so os.stat is used instead.
+    """
+    if not USE_STATX or not sys.platform.startswith("linux"):
+        return None
+    try:
+        statx = ctypes.CDLL(None, use_errno=True).statx
+    except (OSError, AttributeError):
+        return None
+    statx.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int, ctypes.c_uint, ctypes.POINTER(_Statx)]
+    statx.restype = ctypes.c_int
+    return statx
 
 
-def main():
+_statx = _load_statx()
+
+
+def movie_mtime(name: str, dir_fd: int):
+    """
+    Return the modification time of an archive entry relative to dir_fd, or None if it vanished mid-scan.
+    With USE_STATX on, statx asks for the mtime alone, since that is the only field the rotation needs.
+    Otherwise this is a plain os.stat(name, dir_fd=dir_fd).
+    """
+    if _statx is not None:
+        buf = _Statx()
+        if _statx(dir_fd, os.fsencode(name), AT_STATX_DONT_SYNC, STATX_MTIME, ctypes.byref(buf)) == 0:
+            if buf.stx_mask & STATX_MTIME:
+                return buf.stx_mtime.tv_sec + buf.stx_mtime.tv_nsec / 1e9
+        elif ctypes.get_errno() == ENOENT:
+            return None
+        # Any other failure falls through to os.stat: kernels without statx (ENOSYS), seccomp
+        # profiles that block it (EPERM), or filesystems that cannot report the mtime this way.
+        # os.stat raises whatever error is real for this entry.
+    try:
+        return os.stat(name, dir_fd=dir_fd).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def stat_mtimes(names: list[str], dir_fd: int) -> list:
+    """Return movie_mtime() for each name in order. One call is one thread's share of the archive."""
+    return [movie_mtime(name, dir_fd) for name in names]
+
+
+def rotation_candidates(new_movies, old_movies):
+    """
+    Yield movie names in the order they should be linked.
+    New movies come first, newest first, so the rotation shelf always highlights recently added items.
+    Older movies follow in the alphabetical order they were given in.
+    New movies are ordered through a heap, so only the ones actually consumed are ranked.
+    """
+    heap = [(-mtime, name) for mtime, name in new_movies]
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[1]
+    yield from old_movies
+
+
+def build_rotation(rot_fd: int):
+    """Prune stale links and refill the rotation shelf. rot_fd is an open handle on ROTATION_DIR."""
     log("=== Rotation build start ===")
     state = load_state()
     last_run_ts = state.get("last_run", 0)
 
+    # Load current symbolic links in rotation and clear out stale ones.
+    # The survivors are tracked in memory so the directory is only scanned once.
+    current_links = remove_old_links(list_rotation_links(), rot_fd)
+    current_link_names = {link.name for link, _ in current_links}
+    flush_log()
+
+    # Determine how many new rotation entries can be added.
+    current_count = len(current_links)
+    to_fill = MAX_ROTATION_ITEMS - current_count
+    now_ts = time.time()
+
+    # A full shelf cannot take new links, so there is no reason to scan or stat the archive.
+    if to_fill <= 0:
+        log(f"Rotation is full with {current_count} items, skipping archive scan")
+        state["last_run"] = now_ts
+        save_state(state)
+        log("=== Rotation build complete ===")
+        return
+
     # Load names of core movies so they can be excluded from rotation logic.
     core_names = load_core_dirnames()
     log(f"Loaded {len(core_names)} core names")
 
-    # Load current symbolic links in rotation and clear out stale ones.
-    current_links = list_rotation_links()
-    remove_old_links(current_links)
-    current_links = list_rotation_links()
-    current_link_names = {p.name for p in current_links}
-
-    # Collect all media from the archive for sorting.
-    all_movies = scan_movies()
-    now_ts = time.time()
+    # The archive directory's mtime only changes when entries are added, removed, or renamed.
+    # If it matches the last scan, the cached listing is still accurate and nothing is new.
+    movies_dir_mtime = os.stat(MOVIES_DIR).st_mtime
+    use_cache = movies_dir_mtime == state.get("movies_dir_mtime") and ARCHIVE_CACHE_FILE.exists()
 
     # Separate new movies from older ones based on modification timestamp.
     # New movies always take priority in rotation so fresh content is surfaced immediately.
+    # Core titles and titles already on the shelf are never candidates, so they are dropped up front.
     new_movies = []
-    old_movies = []
-    for item in all_movies:
-        if item.name in core_names:
-            continue
-        try:
-            mtime = item.stat().st_mtime
-        except FileNotFoundError:
-            continue
-        if mtime > last_run_ts:
-            new_movies.append((mtime, item))
+    if use_cache:
+        log("Archive unchanged since last scan, using cached listing")
+        # Filtering happens as the listing is read, so changes to the core library never invalidate it.
+        old_movies = iter_archive_cache(core_names | current_link_names)
+    else:
+        # Collect all media from the archive for sorting.
+        # Sorted alphabetically for consistent behavior across runs.
+        # list.sort computes each lowered key once per entry, not once per comparison.
+        by_name = {entry.name: entry for entry in scan_movies()}
+        archive_names = sorted(by_name, key=str.lower)
+        save_archive_cache(archive_names)
+        # Like git's racy index check: an mtime within the safety margin of this run could still
+        # change without moving, so record it as unknown (NaN) and rescan next time.
+        if now_ts - movies_dir_mtime < MTIME_SAFETY_MARGIN:
+            state["movies_dir_mtime"] = float("nan")
         else:
-            old_movies.append(item)
-
-    # Sort new entries by newest first.
-    new_movies.sort(key=lambda t: t[0], reverse=True)
-
-    log(f"Found {len(new_movies)} movies new since last run")
-    log(f"Found {len(old_movies)} older movies")
-
-    # Determine how many new rotation entries can be added.
-    current_count = len(current_links)
-    to_fill = MAX_ROTATION_ITEMS - current_count
+            state["movies_dir_mtime"] = movies_dir_mtime
+
+        # Set difference filters every name in one C-level pass, and only the survivors get stat'd.
+        eligible = by_name.keys() - core_names - current_link_names
+        # Stat in inode order, which walks the inode table in order instead of in hashed readdir order.
+        # inode() comes straight from readdir on POSIX, so sorting costs no syscalls.
+        to_stat = sorted(eligible, key=lambda name: by_name[name].inode())
+        # Entries are stat'd relative to an open handle on the archive, so no full path is resolved per entry.
+        movies_fd = os.open(MOVIES_DIR, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            if len(to_stat) < STAT_PARALLEL_MIN:
+                stamped = stat_mtimes(to_stat, movies_fd)
+            else:
+                # One contiguous slice per thread keeps the pool overhead to a task per worker,
+                # and each thread still walks its share in inode order.
+                size = -(-len(to_stat) // STAT_WORKERS)
+                slices = [to_stat[i:i + size] for i in range(0, len(to_stat), size)]
+                with ThreadPoolExecutor(max_workers=STAT_WORKERS) as pool:
+                    results = pool.map(stat_mtimes, slices, itertools.repeat(movies_fd))
+                    stamped = list(itertools.chain.from_iterable(results))
+        finally:
+            os.close(movies_fd)
+        mtimes = dict(zip(to_stat, stamped))
+
+        new_movies = [
+            (mtime, name) for name, mtime in mtimes.items() if mtime is not None and mtime > last_run_ts
+        ]
+        # Walking the sorted listing keeps older movies in alphabetical order without another sort.
+        old_movies = [
+            name
+            for name in archive_names
+            if (mtime := mtimes.get(name)) is not None and mtime <= last_run_ts
+        ]
+
+        log(f"Found {len(new_movies)} movies new since last run")
+        log(f"Found {len(old_movies)} older movies")
+    flush_log()
+
+    # Plain string paths avoid building a Path object for every link.
+    movies_root = os.fspath(MOVIES_DIR)
+    rotation_root = os.fspath(ROTATION_DIR)
+
+    # Functions used once per link are bound to locals, so the loop resolves them with fast local lookups.
+    symlink = os.symlink
+    join = os.path.join
+
+    # New movies are offered first, then older items fill any remaining slots.
+    # Each one gets a symbolic link inside the rotation directory pointing to the real file.
+    # Linking avoids moving data and prevents filesystem wear.
     added = 0
-
-    def create_link(target: Path):
-        """
-        Create a symbolic link inside the rotation directory pointing to the real file.
-        Linking avoids moving data and prevents filesystem wear.
-        """
-        nonlocal added
-        link_path = ROTATION_DIR / target.name
-        if link_path.exists():
-            return
+    for name in rotation_candidates(new_movies, old_movies):
+        if added >= to_fill:
+            break
+        target = join(movies_root, name)
         try:
-            os.symlink(str(target), str(link_path))
-            added += 1
-            log(f"Linked {link_path} -> {target}")
+            symlink(target, name, dir_fd=rot_fd)
+        except FileExistsError:
+            # current_link_names already rules this out, unless another run raced us.
+            continue
         except Exception as e:
             log(f"Error linking {target}: {e}")
-
-    # First wave: add new movies.
-    # This ensures the rotation shelf always highlights recently added items.
-    for _, movie in new_movies:
-        if added >= to_fill:
-            break
-        if movie.name in current_link_names:
             continue
-        create_link(movie)
-
-    # Second wave: fill any remaining slots with older items.
-    # Sorted alphabetically for consistent behavior across runs.
-    if added < to_fill:
-        old_movies.sort(key=lambda p: p.name.lower())
-        for movie in old_movies:
-            if added >= to_fill:
-                break
-            if movie.name in current_link_names:
-                continue
-            create_link(movie)
+        added += 1
+        log(f"Linked {join(rotation_root, name)} -> {target}")
 
-    log(f"Rotation now has about {len(list_rotation_links())} items")
+    log(f"Rotation now has about {current_count + added} items")
+    flush_log()
 
     # Save the current timestamp for use in the next run.
     state["last_run"] = now_ts
@@ -217,6 +480,17 @@ def main():
     log("=== Rotation build complete ===")
 
 
+def main():
+    # Open the rotation directory once so every link is removed and created relative to it
+    # with unlinkat(2) and symlinkat(2), instead of resolving the full link path on each call.
+    rot_fd = os.open(ROTATION_DIR, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        build_rotation(rot_fd)
+    finally:
+        os.close(rot_fd)
+        flush_log()
+
+
 if __name__ == "__main__":
     main()
 